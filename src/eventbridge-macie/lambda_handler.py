@@ -19,9 +19,12 @@
 * SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import os
-from typing import Optional, Dict, Any
-import json
+import re
+import time
+from typing import Optional, Dict, Any, FrozenSet, Iterator, List, Set, Tuple
 import urllib.parse
 
 from aws_lambda_powertools import Logger, Metrics
@@ -29,157 +32,382 @@ from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.typing import LambdaContext
 import boto3
 import botocore
+from botocore.config import Config
+import fastjsonschema
+import ijson.backends.yajl2_c as ijson
+
+# maximum number of concurrent S3 requests per invocation
+MAX_WORKERS = 32
 
 logger = Logger()
 metrics = Metrics()
-s3 = boto3.client("s3")
+# boto3 clients are thread-safe; size the connection pool for MAX_WORKERS threads
+# and keep connections alive so warm invocations skip the TLS handshake. The
+# signer, addressing style and retries only pin what boto3 already defaults to.
+s3 = boto3.client(
+    "s3",
+    config=Config(
+        signature_version="s3v4",
+        s3={"addressing_style": "virtual"},
+        max_pool_connections=64,
+        tcp_keepalive=True,
+        retries={"total_max_attempts": 3, "mode": "standard"},
+    ),
+)
+
+
+INTEGER = re.compile(r"[+-]?\d+")
+
+
+def int_env(name: str, default: int) -> int:
+    """
+    Return an integer environment variable, or default if it is not set
+    """
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    value = value.strip()
+    if not INTEGER.fullmatch(value):
+        raise Exception(f"{name} must be an integer")
+    return int(value)
+
 
-TAG_KEY_NAME = os.getenv("TAG_KEY_NAME", "Severity")
+TAG_KEY_NAME = os.environ.get("TAG_KEY_NAME", "Severity")
 if not TAG_KEY_NAME:
     raise Exception("No TAG_KEY_NAME environment variable defined")
 
 # objects with a score of SCORE_THRESHOLD or higher will be tagged
-try:
-    SCORE_THRESHOLD = int(os.getenv("SCORE_THRESHOLD", 3))
-except ValueError:
-    raise Exception("SCORE_THRESHOLD must be an integer")
+SCORE_THRESHOLD = int_env("SCORE_THRESHOLD", 3)
+GLACIER_TRANSITION_DAYS = int_env("GLACIER_TRANSITION_DAYS", 365)
+EXPIRE_OBJECTS_DAYS = int_env("EXPIRE_OBJECTS_DAYS", 1825)
 
-try:
-    GLACIER_TRANSITION_DAYS = int(os.getenv("GLACIER_TRANSITION_DAYS", 365))
-except ValueError:
-    raise Exception("GLACIER_TRANSITION_DAYS must be an integer")
+# results objects are partitioned by Kinesis Data Firehose on the finding severity
+# score, e.g. "severity=3/2021/06/01/12/..."
+SEVERITY_PARTITION = re.compile(r"(?:^|/)severity=(\d+)/")
 
-try:
-    EXPIRE_OBJECTS_DAYS = int(os.getenv("EXPIRE_OBJECTS_DAYS", 1825))
-except ValueError:
-    raise Exception("EXPIRE_OBJECTS_DAYS must be an integer")
+# only these keys of the finding "detail" are kept when parsing
+DETAIL_FIELDS = frozenset(["severity", "resourcesAffected"])
 
+# shape of the DETAIL_FIELDS this function relies on
+# @see https://docs.aws.amazon.com/macie/latest/user/findings-json.html
+FINDING_SCHEMA = {
+    "type": "object",
+    "required": ["severity", "resourcesAffected"],
+    "properties": {
+        "severity": {
+            "type": "object",
+            "required": ["score", "description"],
+            "properties": {
+                "score": {"type": "integer"},
+                "description": {"type": "string"},
+            },
+        },
+        "resourcesAffected": {
+            "type": "object",
+            "required": ["s3Bucket", "s3Object"],
+            "properties": {
+                "s3Bucket": {
+                    "type": "object",
+                    "required": ["name"],
+                    "properties": {"name": {"type": "string"}},
+                },
+                "s3Object": {
+                    "type": "object",
+                    "required": ["key"],
+                    "properties": {
+                        "key": {"type": "string"},
+                        "versionId": {"type": ["string", "null"]},
+                    },
+                },
+            },
+        },
+    },
+}
+validate_finding = fastjsonschema.compile(FINDING_SCHEMA)
 
-def get_json_object(
-    bucket: str, key: str, version_id: str = None
-) -> Optional[Dict[str, Any]]:
+# tag values with a lifecycle rule known to exist per bucket, kept across warm
+# invocations. Concurrent invocations can overwrite each other's rules, so
+# entries expire and the configuration is read again after LIFECYCLE_CACHE_TTL.
+LIFECYCLE_CACHE: Dict[str, Tuple[float, FrozenSet[str]]] = {}
+LIFECYCLE_CACHE_TTL = 300  # seconds
+
+# every lifecycle rule shares the same actions, so they are built once and
+# referenced (never mutated) by each rule
+LIFECYCLE_ACTIONS = {
+    "Status": "Enabled",
+    "NoncurrentVersionTransitions": [
+        {
+            "NoncurrentDays": GLACIER_TRANSITION_DAYS,
+            "StorageClass": "GLACIER",
+        },
+    ],
+    "NoncurrentVersionExpiration": {"NoncurrentDays": EXPIRE_OBJECTS_DAYS},
+}
+
+
+def get_finding_details(
+    bucket: str, key: str, version_id: str = None, log_keys: Dict[str, Any] = None
+) -> Iterator[Dict[str, Any]]:
     """
-    Return a parsed JSON object from an S3 bucket
+    Yield the DETAIL_FIELDS of each Macie finding "detail" stored in an S3 object
     """
     params = {"Bucket": bucket, "Key": key}
     if version_id:
         params["VersionId"] = version_id
 
-    logger.append_keys(bucket=bucket, key=key, version=version_id)
-    logger.debug("Retrieving object")
+    if log_keys is None:
+        log_keys = {"bucket": bucket, "key": key, "version": version_id}
+    logger.debug("Retrieving object", extra=log_keys)
     try:
         response = s3.get_object(**params)
-        data = response["Body"].read().decode("utf-8")
-        return json.loads(data)
+        # Kinesis Data Firehose concatenates findings into one object, so stream
+        # every JSON document out of the body without buffering the whole object
+        details = ijson.items(response["Body"], "detail", multiple_values=True)
+        for detail in details:
+            yield {k: v for k, v in detail.items() if k in DETAIL_FIELDS}
     except Exception:
-        logger.exception("Unable to get object")
+        logger.exception("Unable to get object", extra=log_keys)
 
 
-def tag_object(value: str, bucket: str, key: str, version_id: str = None) -> None:
+def tag_object(value: str, bucket: str, key: str, version_id: str = None) -> bool:
     """
-    Add a new tag (TAG_KEY_NAME) to an existing S3 object
+    Add a new tag (TAG_KEY_NAME) to an existing S3 object, returning whether
+    the tag was added
     """
     params = {
         "Bucket": bucket,
         "Key": key,
-        "Tagging": {"TagSet": [{"Key": TAG_KEY_NAME, "Value": str(value)}]},
+        "Tagging": {"TagSet": [{"Key": TAG_KEY_NAME, "Value": value}]},
     }
     if version_id:
         params["VersionId"] = version_id
 
-    logger.append_keys(bucket=bucket, key=key, version=version_id)
+    # tagging runs on worker threads, so keys are passed per log call rather
+    # than appended to the shared logger state
+    log_keys = {"bucket": bucket, "key": key, "version": version_id}
     try:
         s3.put_object_tagging(**params)
-        logger.debug(f"Successfully added {TAG_KEY_NAME} tag")
     except botocore.exceptions.ClientError:
-        logger.exception(f"Unable to add {TAG_KEY_NAME} tag")
-        metrics.add_metric(name="TaggingFailed", unit=MetricUnit.Count, value=1)
-    else:
-        metrics.add_metric(name="TaggingSuccess", unit=MetricUnit.Count, value=1)
+        logger.exception(f"Unable to add {TAG_KEY_NAME} tag", extra=log_keys)
+        return False
 
+    logger.debug(f"Successfully added {TAG_KEY_NAME} tag", extra=log_keys)
+    return True
 
-def lifecycle_config(bucket: str, key: str) -> None:
+
+def lifecycle_rule_id(value: str) -> str:
     """
-    Add a new lifecycle configuration to a bucket
+    Return the ID of the lifecycle rule for TAG_KEY_NAME=value
     """
-    config = {
-        "Rules": [
-            {
-                "Filter": {"Prefix": key},
-                "Status": "Enabled",
-                "NoncurrentVersionTransitions": [
-                    {
-                        "NoncurrentDays": GLACIER_TRANSITION_DAYS,
-                        "StorageClass": "GLACIER",
-                    },
-                ],
-                "NoncurrentVersionExpiration": {"NoncurrentDays": EXPIRE_OBJECTS_DAYS},
-            },
-        ]
+    return f"{TAG_KEY_NAME}={value}"
+
+
+def lifecycle_rule(value: str) -> Dict[str, Any]:
+    """
+    Return a lifecycle rule transitioning and expiring versions tagged with
+    TAG_KEY_NAME=value
+    """
+    return {
+        "ID": lifecycle_rule_id(value),
+        "Filter": {"Tag": {"Key": TAG_KEY_NAME, "Value": value}},
+        **LIFECYCLE_ACTIONS,
     }
 
-    logger.append_keys(bucket=bucket)
+
+def get_lifecycle_rules(bucket: str) -> List[Dict[str, Any]]:
+    """
+    Return the existing lifecycle rules of a bucket
+    """
+    try:
+        response = s3.get_bucket_lifecycle_configuration(Bucket=bucket)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchLifecycleConfiguration":
+            return []
+        raise
+    return response.get("Rules", [])
+
+
+def lifecycle_config(bucket: str, values: Set[str]) -> None:
+    """
+    Merge a lifecycle rule for each TAG_KEY_NAME tag value into a bucket's
+    configuration
+    """
+    log_keys = {"bucket": bucket}
+    cached_at, cached = LIFECYCLE_CACHE.get(bucket, (0.0, frozenset()))
+    if values <= cached and time.monotonic() - cached_at < LIFECYCLE_CACHE_TTL:
+        logger.debug("Lifecycle configuration already cached, skipping", extra=log_keys)
+        return
+
     try:
+        rules = get_lifecycle_rules(bucket)
+        tags = (rule.get("Filter", {}).get("Tag", {}) for rule in rules)
+        existing = {tag.get("Value") for tag in tags if tag.get("Key") == TAG_KEY_NAME}
+
+        # rule IDs must be unique, so a rule that already uses one of our IDs with
+        # a different filter is left alone rather than failing the PUT every time
+        ids = {rule.get("ID") for rule in rules}
+        clashes = {
+            value for value in values - existing if lifecycle_rule_id(value) in ids
+        }
+        if clashes:
+            logger.warn(
+                f"Lifecycle rule IDs already in use, skipping: {sorted(clashes)}",
+                extra=log_keys,
+            )
+            existing.update(clashes)
+
+        missing = sorted(values - existing)
+        if not missing:
+            LIFECYCLE_CACHE[bucket] = (time.monotonic(), frozenset(existing))
+            logger.debug("Lifecycle configuration already up to date", extra=log_keys)
+            return
+
+        rules.extend(lifecycle_rule(value) for value in missing)
         s3.put_bucket_lifecycle_configuration(
-            Bucket=bucket, LifecycleConfiguration=config
+            Bucket=bucket, LifecycleConfiguration={"Rules": rules}
+        )
+        LIFECYCLE_CACHE[bucket] = (
+            time.monotonic(),
+            frozenset(existing.union(missing)),
+        )
+        logger.debug(
+            f"Successfully added {len(missing)} lifecycle rules", extra=log_keys
         )
-        logger.debug(f"Successfully added lifecycle configuration")
     except botocore.exceptions.ClientError:
-        logger.exception("Unable to add lifecycle configuration")
+        logger.exception("Unable to add lifecycle configuration", extra=log_keys)
 
 
-def process_record(record: Dict[str, Any]) -> None:
+def process_finding(
+    detail: Dict[str, Any], counts: Counter, log_keys: Dict[str, Any] = None
+) -> Optional[Dict[str, Any]]:
     """
-    Process an individual S3 event notification record
+    Process an individual Macie finding, returning the tag_object() arguments
+    for the affected object if it should be tagged. log_keys identify the
+    object the finding was read from.
     """
-    bucket = record.get("s3", {}).get("bucket", {}).get("name")
-    key = record.get("s3", {}).get("object", {}).get("key")
-    if key:
-        key = urllib.parse.unquote_plus(key)
-
-    version_id = record.get("s3", {}).get("object", {}).get("versionId")
-    data = get_json_object(bucket, key, version_id)
-    if not data:
-        logger.warn("No data found in S3 object")
-        metrics.add_metric(name="EmptyObject", unit=MetricUnit.Count, value=1)
+    if not detail:
+        logger.warn("No data found in Macie finding", extra=log_keys)
+        counts["EmptyObject"] += 1
         return
 
-    detail = data.get("detail", {})
-    severity_score = int(detail["severity"]["score"])
-    severity_desc = detail["severity"]["description"]
-    resourcesAffected = detail.get("resourcesAffected", {})
-    if not resourcesAffected:
-        logger.warn("No resourcesAffected found in Macie event")
-        metrics.add_metric(name="MissingResources", unit=MetricUnit.Count, value=1)
+    try:
+        validate_finding(detail)
+    except fastjsonschema.JsonSchemaException as e:
+        logger.warn(f"Malformed Macie finding: {e.message}", extra=log_keys)
+        counts["MalformedFinding"] += 1
         return
 
+    severity_score = detail["severity"]["score"]
+    severity_desc = detail["severity"]["description"]
+    resourcesAffected = detail["resourcesAffected"]
     affected_bucket = resourcesAffected["s3Bucket"]["name"]
     affected_key = resourcesAffected["s3Object"]["key"]
     affected_version = resourcesAffected["s3Object"].get("versionId")
 
-    logger.append_keys(
-        bucket=affected_bucket, key=affected_key, version=affected_version
-    )
+    log_keys = {
+        "bucket": affected_bucket,
+        "key": affected_key,
+        "version": affected_version,
+    }
 
     if severity_score < SCORE_THRESHOLD:
         logger.debug(
-            f"{severity_score} ({severity_desc}) < {SCORE_THRESHOLD}, skipping"
+            f"{severity_score} ({severity_desc}) < {SCORE_THRESHOLD}, skipping",
+            extra=log_keys,
         )
-        metrics.add_metric(name="TaggingSkipped", unit=MetricUnit.Count, value=1)
+        counts["TaggingSkipped"] += 1
         return
 
     logger.info(
-        f"{severity_score} ({severity_desc}) >= {SCORE_THRESHOLD}, adding tag and lifecycle policy"
+        f"{severity_score} ({severity_desc}) >= {SCORE_THRESHOLD}, adding tag and lifecycle policy",
+        extra=log_keys,
     )
 
-    tag_object(
-        value=severity_desc,
-        bucket=affected_bucket,
-        key=affected_key,
-        version_id=affected_version,
-    )
+    return {
+        "value": severity_desc,
+        "bucket": affected_bucket,
+        "key": affected_key,
+        "version_id": affected_version,
+    }
+
+
+def process_record(record: Dict[str, Any], counts: Counter) -> List[Dict[str, Any]]:
+    """
+    Process an individual S3 event notification record, returning the
+    tag_object() arguments for every affected object that should be tagged
+    """
+    try:
+        s3_record = record["s3"]
+        s3_object = s3_record["object"]
+        bucket = s3_record["bucket"]["name"]
+        key = s3_object["key"]
+        # S3 event keys are URL encoded, but most keys need no decoding
+        if "%" in key or "+" in key:
+            key = urllib.parse.unquote_plus(key)
+        version_id = s3_object.get("versionId")
+    except KeyError:
+        logger.warn("No S3 object found in event record")
+        counts["InvalidRecord"] += 1
+        return []
+
+    # affected objects are tagged from worker threads, so rather than appending
+    # keys to the shared logger state they are built once and passed to each call
+    log_keys = {"bucket": bucket, "key": key, "version": version_id}
+
+    # every finding in a severity partition shares its score, so objects below the
+    # threshold are skipped without being downloaded
+    match = SEVERITY_PARTITION.search(key)
+    if match and int(match.group(1)) < SCORE_THRESHOLD:
+        logger.debug(
+            f"Partition severity {match.group(1)} < {SCORE_THRESHOLD}, skipping",
+            extra=log_keys,
+        )
+        counts["ObjectSkipped"] += 1
+        return []
+
+    targets = []
+    found = False
+    for detail in get_finding_details(bucket, key, version_id, log_keys):
+        found = True
+        target = process_finding(detail, counts, log_keys)
+        if target:
+            targets.append(target)
+
+    if not found:
+        logger.warn("No data found in S3 object", extra=log_keys)
+        counts["EmptyObject"] += 1
+
+    return targets
+
+
+def process_records(records: List[Dict[str, Any]], counts: Counter) -> None:
+    """
+    Tag and add lifecycle rules for every affected object in the records
+    """
+    # S3 event notifications carry a single record, so records are read in turn
+    targets = []
+    for record in records:
+        targets.extend(process_record(record, counts))
+
+    if not targets:
+        return
 
-    lifecycle_config(bucket=affected_bucket, key=affected_key)
+    # lifecycle rules match on the tag added to each object, so a bucket needs at
+    # most one rule per severity and its configuration is written once
+    values = defaultdict(set)
+    for target in targets:
+        values[target["bucket"]].add(target["value"])
+
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(targets))) as executor:
+        tagged = [executor.submit(tag_object, **target) for target in targets]
+        lifecycles = [
+            executor.submit(lifecycle_config, bucket, bucket_values)
+            for bucket, bucket_values in values.items()
+        ]
+        for future in tagged:
+            counts["TaggingSuccess" if future.result() else "TaggingFailed"] += 1
+        for future in lifecycles:
+            future.result()
 
 
 @metrics.log_metrics(capture_cold_start_metric=True)
@@ -188,5 +416,13 @@ def handler(event: Dict[str, Any], context: LambdaContext) -> None:
     records = event.get("Records", [])
 
     logger.info(f"Found {len(records)} records in event")
-    for record in records:
-        process_record(record)
+    if not records:
+        return
+
+    # metrics are counted across the whole event and emitted once per name
+    counts = Counter()
+    try:
+        process_records(records, counts)
+    finally:
+        for name, value in counts.items():
+            metrics.add_metric(name=name, unit=MetricUnit.Count, value=value)
@@ -25,6 +25,7 @@ from aws_lambda_powertools import Logger
 from aws_lambda_powertools.utilities.typing import LambdaContext
 import boto3
 import botocore
+from botocore.config import Config
 from crhelper import CfnResource
 
 helper = CfnResource(
@@ -36,7 +37,9 @@ helper = CfnResource(
 
 try:
     logger = Logger()
-    s3 = boto3.client("s3")
+    s3 = boto3.client(
+        "s3", config=Config(tcp_keepalive=True, retries={"mode": "standard"})
+    )
 except Exception as e:
     helper.init_failure(e)
 